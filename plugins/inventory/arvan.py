@@ -104,6 +104,63 @@ DOCUMENTATION = r'''
             description: Ignore dcs which api request for list of their servers failed
             type: bool
             default: True
+        snapshot_path:
+            description:
+            - Path to a SQLite snapshot of dcs and servers fetched from API.
+            - Servers are indexed by dc and tag, so only servers matching I(filter_by_dcs) and I(filter_by_tag) are read from it.
+            - Dcs fetched in last I(snapshot_timeout) seconds are loaded from snapshot instead of API.
+            - Snapshot is cleared when it is used with another I(api_endpoint) or API key.
+            - If not specified, snapshot is not used.
+            type: path
+            env:
+                - name: ARVAN_SNAPSHOT_PATH
+        snapshot_timeout:
+            description: Age in seconds after which a dc in snapshot is fetched again from API.
+            type: int
+            default: 3600
+            env:
+                - name: ARVAN_SNAPSHOT_TIMEOUT
+        snapshot_lock_timeout:
+            description:
+            - Seconds to wait for another process fetching from API into the same I(snapshot_path).
+            - Processes running at the same time fetch once, the first one fills snapshot and others read it after waiting on a lock file
+              next to I(snapshot_path).
+            - Lock is released when its owner exits, even if it is killed. After timeout, API is called without lock.
+            type: int
+            default: 60
+            env:
+                - name: ARVAN_SNAPSHOT_LOCK_TIMEOUT
+        refresh_dcs:
+            description:
+            - Fetch servers of these dcs (dc code or dc name) from API and serve other dcs from I(snapshot_path) regardless of I(snapshot_timeout).
+            - List of dcs is always fetched from API.
+            - Dcs missing from snapshot are fetched too, so the inventory is the same as a full fetch.
+            - Has no effect if I(snapshot_path) is not specified.
+            type: list
+            env:
+                - name: ARVAN_REFRESH_DCS
+        delta_state_path:
+            description:
+            - Path to a JSON file keeping dc and a fingerprint of id, status, addresses, tags and task_state of each server from previous run.
+            - If specified, servers not in previous run are added to group I(arvan_added), servers with a different fingerprint are
+              added to group I(arvan_changed) and ids of servers of previous run which are gone are set in I(arvan_removed_ids) var of group I(arvan).
+            - If the file does not exist, all servers are added to group I(arvan_added).
+            - Servers of dcs which could not be fetched (see I(ignore_failed_dcs)) are not reported as removed and are kept for next run.
+            - Use a separate file for each inventory file, as servers excluded by filters are reported as removed.
+            type: path
+            env:
+                - name: ARVAN_DELTA_STATE_PATH
+        parallel_workers:
+            description:
+            - Number of worker processes used to parse servers and evaluate I(compose), I(groups) and I(keyed_groups) per dc.
+            - Hosts built by workers are merged into inventory in dc order, the result is the same as without parallel mode.
+            - Values of 0 or 1 disable parallel mode.
+            - Worker processes are started with the C(fork) start method, on platforms without it and on macOS hosts are built serially.
+            - Python 3.12 and later emit a C(DeprecationWarning) when forking while other threads are running in the controller.
+            type: int
+            default: 0
+            env:
+                - name: ARVAN_PARALLEL_WORKERS
 '''
 
 EXAMPLES = r'''
@@ -139,16 +196,41 @@ filter_by_dcs:
   - Herman
   - ir-thr-at1
 
+# Keep fetched dcs in a snapshot for 10 minutes
+plugin: arvancloud.iaas.arvan
+snapshot_path: ~/.cache/arvan_inventory.sqlite
+snapshot_timeout: 600
+
+# Fetch only ir-thr-c2 again and take other dcs from snapshot
+plugin: arvancloud.iaas.arvan
+snapshot_path: ~/.cache/arvan_inventory.sqlite
+refresh_dcs:
+  - ir-thr-c2
+
+# Report servers added, changed or removed since previous run
+plugin: arvancloud.iaas.arvan
+delta_state_path: ~/.cache/arvan_inventory_delta.json
+
+# Parse servers of each dc in a pool of 4 processes
+plugin: arvancloud.iaas.arvan
+parallel_workers: 4
 
 '''
 
+import errno
+import fcntl
 import json
+import hashlib
 import time
 import threading
 import random
 import os
+import stat
+import sys
+import tempfile
 
 from ansible.errors import AnsibleError
+from ansible.inventory.data import InventoryData
 from ansible.plugins.inventory import BaseInventoryPlugin, Constructable
 try:
     # python3
@@ -156,8 +238,7 @@ try:
 except ImportError:
     # python2
     from ConfigParser import ConfigParser
-from ansible.module_utils.urls import open_url
-from ansible.module_utils._text import to_native
+from ansible.module_utils._text import to_bytes, to_native
 
 ARVAN_API_ENDPOINT = "https://napi.arvancloud.com/ecc/v1"
 ARVAN_USER_AGENT = 'Ansible Arvan'
@@ -183,6 +264,9 @@ class GetAPIRequestThread(threading.Thread):
             self.url = '%s/regions/%s/%s' % (endpoint, dc, resource)
 
     def run(self):
+        # urls imports ssl, http and email modules, import it only when API is called
+        from ansible.module_utils.urls import open_url
+
         randomness = random.randint(0, 1000) / 1000.0
         for try_counter in range(self.retries):
             try:
@@ -216,6 +300,133 @@ class GetAPIRequestThread(threading.Thread):
                 break
 
 
+class SnapshotLock:
+    '''
+    Lock file which lets only one process at a time fetch from API and fill snapshot
+
+    Lock is held with flock, so it is released by the kernel if its owner exits without releasing it
+    '''
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+        self.timed_out = False
+
+    def acquire(self):
+        '''
+        Wait for lock up to timeout seconds, return True if lock is newly acquired
+        '''
+        if self.fd is not None or self.timed_out:
+            return False
+        try:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+        except OSError as e:
+            raise AnsibleError("Error opening lock %s: %s" % (self.path, to_native(e)))
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise AnsibleError("Error locking %s: %s" % (self.path, to_native(e)))
+                if time.time() >= deadline:
+                    print("Timeout waiting for lock %s, fetching without it" % self.path)
+                    os.close(fd)
+                    self.timed_out = True
+                    return False
+                time.sleep(0.1 + random.randint(0, 100) / 1000.0)
+                continue
+            self.fd = fd
+            return True
+
+    def release(self):
+        # Lock file is not removed, another process may already wait on it
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+class InventorySnapshot:
+    '''
+    SQLite snapshot of dcs and servers fetched from API, indexed by dc and tag
+
+    Snapshot is cleared if it was filled with another identity (API endpoint and key)
+    '''
+    def __init__(self, path, identity):
+        import sqlite3
+
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        # Let sqlite read pages of snapshot through memory map instead of read calls
+        self.connection.execute("PRAGMA mmap_size=268435456")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS dcs (position INTEGER, entry TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS fetches (resource TEXT PRIMARY KEY, fetched_at REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS servers (dc TEXT, position INTEGER, id TEXT, entry TEXT)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS servers_dc ON servers (dc, position)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS server_tags (dc TEXT, tag TEXT, position INTEGER)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS server_tags_dc_tag ON server_tags (dc, tag)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            row = self.connection.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+            if not row or row[0] != identity:
+                for table in ("dcs", "fetches", "servers", "server_tags"):
+                    self.connection.execute("DELETE FROM %s" % table)
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('identity', ?)", (identity,))
+
+    def close(self):
+        self.connection.close()
+
+    def fresh_resources(self, max_age=None):
+        '''
+        Return name of resources fetched in last max_age seconds, or all stored resources if max_age is None
+        '''
+        if max_age is None:
+            rows = self.connection.execute("SELECT resource FROM fetches")
+        else:
+            rows = self.connection.execute("SELECT resource FROM fetches WHERE fetched_at >= ?", (time.time() - max_age,))
+        return set(row[0] for row in rows)
+
+    def load_dcs(self):
+        return [json.loads(row[0]) for row in self.connection.execute("SELECT entry FROM dcs ORDER BY position")]
+
+    def save_dcs(self, dc_entries):
+        with self.connection:
+            self.connection.execute("DELETE FROM dcs")
+            self.connection.executemany("INSERT INTO dcs VALUES (?, ?)", ((position, json.dumps(entry)) for position, entry in enumerate(dc_entries)))
+            self.connection.execute("INSERT OR REPLACE INTO fetches VALUES ('regions', ?)", (time.time(),))
+
+    def load_servers(self, dc, tag=None):
+        '''
+        Return servers of a dc in API order, only servers having tag if specified
+        '''
+        if tag:
+            rows = self.connection.execute(
+                "SELECT servers.entry FROM server_tags JOIN servers ON servers.dc = server_tags.dc AND servers.position = server_tags.position "
+                "WHERE server_tags.dc = ? AND server_tags.tag = ? ORDER BY servers.position", (dc, tag))
+        else:
+            rows = self.connection.execute("SELECT entry FROM servers WHERE dc = ? ORDER BY position", (dc,))
+        return [json.loads(row[0]) for row in rows]
+
+    def save_servers(self, dc, server_entries):
+        with self.connection:
+            self.connection.execute("DELETE FROM servers WHERE dc = ?", (dc,))
+            self.connection.execute("DELETE FROM server_tags WHERE dc = ?", (dc,))
+            for position, entry in enumerate(server_entries):
+                self.connection.execute("INSERT INTO servers VALUES (?, ?, ?, ?)", (dc, position, entry.get("id"), json.dumps(entry)))
+                tags = set(tag.get("name") for tag in entry.get("tags") or list() if isinstance(tag, dict))
+                self.connection.executemany("INSERT INTO server_tags VALUES (?, ?, ?)", ((dc, tag, position) for tag in tags))
+            self.connection.execute("INSERT OR REPLACE INTO fetches VALUES (?, ?)", ("servers/%s" % dc, time.time()))
+
+
+def snapshot_identity(endpoint, api_key):
+    '''
+    Return a hash of API endpoint and key, so snapshot does not keep the key itself
+    '''
+    return hashlib.sha256(("%s\n%s" % (endpoint, api_key)).encode("utf-8")).hexdigest()
+
+
 def get_nested_dicts(parent_dict, keys):
     '''
     Retrun value of a key in nested dicts
@@ -295,6 +506,86 @@ def load_conf(path, ini_group):
         return dict(conf.items(ini_group))
 
 
+def host_fingerprint(host_vars):
+    '''
+    Return a short hash of host vars which are compared between runs in delta mode
+    '''
+    keys = ("id", "status", "v4_public_ip", "v4_private_ip", "v6_public_ip", "tags", "task_state")
+    data = json.dumps([host_vars.get(key) for key in keys], sort_keys=True)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()[:16]
+
+
+def write_file_atomic(path, content):
+    '''
+    Write content to a temporary file next to path and rename it over path
+
+    Mode of an existing file is kept, a new file gets default mode of the umask
+    '''
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".%s." % os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(to_bytes(content))
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def host_variables(host):
+    '''
+    Return variables of host without the ones set by ansible itself for every host
+    '''
+    return dict((k, v) for k, v in host.vars.items() if k not in ("inventory_file", "inventory_dir"))
+
+
+def dump_inventory_data(inventory):
+    '''
+    Convert hosts and groups of an inventory to plain lists which can be sent between processes
+    '''
+    hosts = list()
+    for name, host in inventory.hosts.items():
+        hosts.append((name, host_variables(host)))
+    groups = list()
+    for name, group in inventory.groups.items():
+        if name in ("all", "ungrouped"):
+            continue
+        groups.append((name, [child.name for child in group.child_groups], [host.name for host in group.hosts], dict(group.vars)))
+    return dict(hosts=hosts, groups=groups)
+
+
+# InventoryModule instance used by worker processes of parallel mode
+worker_plugin = None
+
+
+def init_worker(plugin):
+    '''
+    Keep the plugin inherited from parent process to be used by populate_dc_worker
+    '''
+    global worker_plugin
+    worker_plugin = plugin
+
+
+def populate_dc_worker(dc_full_code, server_entries, host_names):
+    '''
+    Build hosts of a dc in an empty inventory and return its dump, or the error message if building failed
+    '''
+    try:
+        worker_plugin.inventory = InventoryData()
+        worker_plugin.inventory.add_group(group='arvan')
+        worker_plugin._populate_dc(dc_full_code, server_entries, host_names)
+        return dump_inventory_data(worker_plugin.inventory)
+    except Exception as e:
+        # Exceptions raised by templating can not always be sent to parent process, so only their message is sent
+        return dict(error=to_native(e))
+
+
 DC_SCHEMA = {
     "dc_flag": dict(keys=("flag",)),
     "country": dict(keys=("country",)),
@@ -333,6 +624,10 @@ SERVER_SCHEMA = {
 }
 
 
+# Server fields needed to set host names before servers are fully parsed
+HOST_NAME_SCHEMA = dict((field_name, SERVER_SCHEMA[field_name]) for field_name in ("id", "name", "tags"))
+
+
 class InventoryModule(BaseInventoryPlugin, Constructable):
 
     NAME = 'arvancloud.iaas.arvan'
@@ -377,125 +672,329 @@ class InventoryModule(BaseInventoryPlugin, Constructable):
             except AttributeError:
                 raise AnsibleError("Error parsing filter_by_dcs")
 
+        refresh_dcs = self.get_option('refresh_dcs')
+
+        if refresh_dcs:
+            try:
+                refresh_dcs = [dc.lower() for dc in refresh_dcs]
+            except AttributeError:
+                raise AnsibleError("Error parsing refresh_dcs")
+
         other_arguments = {"api_key": self.api_key, "retry_max_delay": self.retry_max_delay,
                            "retries": self.retries, "timeout": self.timeout, "endpoint": self.endpoint}
-        # fetch all DCs by API
-        dcs_thread = GetAPIRequestThread(resource='regions', **other_arguments)
-        dcs_thread.start()
-        dcs_thread.join()
-
-        if dcs_thread.response_status == 200:
-            dcs = dict()
-            for dc_entry in dcs_thread.response_data:
-                dc = parse_object(dc_entry, DC_SCHEMA)
-                try:
-                    dc_name = dc.get("dc_name").lower()
-                    dc_full_code = dc.get("dc_full_code")
-                    # Ignore dcs with soon flag
-                    if dc['dc_soon'] and self.get_option("ignore_soon_dcs"):
-                        continue
-                    # Ignore dcs not in filter_by_dcs
-                    if filter_by_dcs and dc_name not in filter_by_dcs and dc_full_code not in filter_by_dcs:
-                        continue
-                    dcs[dc_full_code] = dc
-                except Exception:
-                    raise AnsibleError("Error parsing list Of dcs")
-        else:
-            raise AnsibleError("Could not fetch dcs")
+        snapshot = None
+        snapshot_lock = None
+        if self.get_option('snapshot_path'):
+            import sqlite3
 
-        del dcs_thread
+            try:
+                snapshot = InventorySnapshot(self.get_option('snapshot_path'), snapshot_identity(self.endpoint, self.api_key))
+            except sqlite3.Error as e:
+                raise AnsibleError("Error opening snapshot %s: %s" % (self.get_option('snapshot_path'), to_native(e)))
+            snapshot_lock = SnapshotLock(self.get_option('snapshot_path') + ".lock", self.get_option('snapshot_lock_timeout'))
 
-        # Fetch servers from each DC by API
-        servers_threads = [GetAPIRequestThread(dc=dc, resource='servers', **other_arguments) for dc in dcs]
-        for thread in servers_threads:
+        try:
+            dc_servers = self._fetch_dc_servers(snapshot, snapshot_lock, filter_by_dcs, refresh_dcs, other_arguments)
+        finally:
+            # Snapshot is filled, let waiting processes read it. It is closed before hosts are built, so no
+            # connection or lock is inherited by worker processes of parallel mode.
+            if snapshot_lock:
+                snapshot_lock.release()
+            if snapshot:
+                snapshot.close()
+
+        self._populate_dcs(dc_servers)
+
+        if self.get_option('delta_state_path'):
+            self._populate_delta(self.get_option('delta_state_path'))
+
+    def _populate_delta(self, state_path):
+        '''
+        Compare hosts with fingerprints of previous run and add arvan_added, arvan_changed groups and arvan_removed_ids var
+        '''
+        try:
+            with open(state_path) as fp:
+                previous = json.load(fp)
+        except (IOError, OSError):
+            previous = dict()
+        except ValueError:
+            raise AnsibleError("Error parsing delta state %s" % state_path)
+        # Each entry must be [dc, fingerprint] keyed by server id
+        if not isinstance(previous, dict) or not all(isinstance(v, list) and len(v) == 2 for v in previous.values()):
+            raise AnsibleError("Error parsing delta state %s" % state_path)
+
+        current = dict()
+        host_names = dict()
+        for host in self.inventory.groups['arvan'].hosts:
+            server_id = host.vars.get("id")
+            if server_id is not None:
+                current[server_id] = [host.vars.get("dc_full_code"), host_fingerprint(host.vars)]
+                host_names[server_id] = host.name
+
+        self.inventory.add_group(group='arvan_added')
+        self.inventory.add_group(group='arvan_changed')
+        for server_id, (dc, fingerprint) in current.items():
+            if server_id not in previous:
+                self.inventory.add_host(host=host_names[server_id], group='arvan_added')
+            elif previous[server_id][1] != fingerprint:
+                self.inventory.add_host(host=host_names[server_id], group='arvan_changed')
+
+        removed_ids = list()
+        for server_id, (dc, fingerprint) in previous.items():
+            if server_id in current:
+                continue
+            if dc in self.failed_dcs:
+                # Servers of dcs which could not be fetched are kept for next run instead of being reported as removed
+                current[server_id] = [dc, fingerprint]
+            else:
+                removed_ids.append(server_id)
+        self.inventory.set_variable('arvan', 'arvan_removed_ids', sorted(removed_ids))
+
+        try:
+            write_file_atomic(state_path, json.dumps(current, sort_keys=True))
+        except (IOError, OSError) as e:
+            raise AnsibleError("Error writing delta state %s: %s" % (state_path, to_native(e)))
+
+    def _fresh_resources(self, snapshot, refresh_dcs):
+        if not snapshot:
+            return set()
+        if refresh_dcs:
+            # Only dcs in refresh_dcs are fetched again, others are served from snapshot regardless of their age.
+            # List of dcs is always fetched again, so new dcs or dcs which are not soon anymore are not skipped.
+            return snapshot.fresh_resources() - set(["regions"])
+        return snapshot.fresh_resources(self.get_option('snapshot_timeout'))
+
+    def _fetch_dc_servers(self, snapshot, snapshot_lock, filter_by_dcs, refresh_dcs, other_arguments):
+        fresh_resources = self._fresh_resources(snapshot, refresh_dcs)
+        # Only one process fetches from API at a time, others wait and read what it stored in snapshot
+        if "regions" not in fresh_resources and snapshot_lock and snapshot_lock.acquire():
+            fresh_resources = self._fresh_resources(snapshot, refresh_dcs)
+
+        if "regions" in fresh_resources:
+            dc_entries = snapshot.load_dcs()
+        else:
+            # fetch all DCs by API
+            dcs_thread = GetAPIRequestThread(resource='regions', **other_arguments)
+            dcs_thread.start()
+            dcs_thread.join()
+            if dcs_thread.response_status != 200:
+                raise AnsibleError("Could not fetch dcs")
+            dc_entries = dcs_thread.response_data
+            del dcs_thread
+            if snapshot:
+                snapshot.save_dcs(dc_entries)
+
+        dcs = dict()
+        for dc_entry in dc_entries:
+            dc = parse_object(dc_entry, DC_SCHEMA)
+            try:
+                dc_name = dc.get("dc_name").lower()
+                dc_full_code = dc.get("dc_full_code")
+                # Ignore dcs with soon flag
+                if dc['dc_soon'] and self.get_option("ignore_soon_dcs"):
+                    continue
+                # Ignore dcs not in filter_by_dcs
+                if filter_by_dcs and dc_name not in filter_by_dcs and dc_full_code not in filter_by_dcs:
+                    continue
+                dcs[dc_full_code] = dc
+            except Exception:
+                raise AnsibleError("Error parsing list Of dcs")
+
+        # Fetch servers from each DC by API unless they are fresh in snapshot and not in refresh_dcs
+        fetch_dcs = self._dcs_to_fetch(dcs, fresh_resources, refresh_dcs)
+        if fetch_dcs and snapshot_lock and snapshot_lock.acquire():
+            fetch_dcs = self._dcs_to_fetch(dcs, self._fresh_resources(snapshot, refresh_dcs), refresh_dcs)
+        servers_threads = dict((dc, GetAPIRequestThread(dc=dc, resource='servers', **other_arguments)) for dc in fetch_dcs)
+        for thread in servers_threads.values():
             thread.start()
-        for thread in servers_threads:
+        for thread in servers_threads.values():
             thread.join()
 
         # Add a top group 'arvan'
         self.inventory.add_group(group='arvan')
 
-        # Filter by tag is not supported by the api and will be checked against every server
-        filter_by_tag = self.get_option('filter_by_tag')
-        # Use constructed if applicable
-        strict = self.get_option('strict')
-
-        for thread in servers_threads:
+        self.dcs = dcs
+        self.failed_dcs = list()
+        dc_servers = list()
+        for dc in dcs:
+            if dc not in servers_threads:
+                # Filter by tag is applied by snapshot index
+                dc_servers.append((dc, snapshot.load_servers(dc, tag=self.get_option('filter_by_tag'))))
+                continue
+            thread = servers_threads[dc]
             if thread.response_status != 200:
                 if not self.get_option("ignore_failed_dcs"):
                     raise AnsibleError("Fetching servers in %s failed" % thread.dc)
                 else:
                     print("Fetching servers in %s failed" % thread.dc)
+                    self.failed_dcs.append(dc)
+            else:
+                if snapshot:
+                    snapshot.save_servers(dc, thread.response_data)
+                dc_servers.append((dc, thread.response_data))
+        return dc_servers
+
+    def _populate_dcs(self, dc_servers):
+        parallel_workers = self.get_option('parallel_workers')
+        if parallel_workers and parallel_workers > 1 and len(dc_servers) > 1:
+            import multiprocessing
+
+            # Worker processes inherit the plugin by fork, which is not available on every platform and not safe on macOS
+            if 'fork' in multiprocessing.get_all_start_methods() and sys.platform != 'darwin':
+                self._populate_parallel(dc_servers, parallel_workers)
+                return
+        for dc_full_code, server_entries in dc_servers:
+            self._populate_dc(dc_full_code, server_entries)
+
+    def _dcs_to_fetch(self, dcs, fresh_resources, refresh_dcs):
+        fetch_dcs = list()
+        for dc in dcs:
+            if "servers/%s" % dc in fresh_resources:
+                if not refresh_dcs or (dcs[dc]["dc_name"].lower() not in refresh_dcs and dc not in refresh_dcs):
+                    continue
+            fetch_dcs.append(dc)
+        return fetch_dcs
+
+    def _populate_parallel(self, dc_servers, parallel_workers):
+        '''
+        Build hosts of each DC in a process pool and merge them in DC order
+        '''
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        # Host names depend on hosts of previous dcs, so they are set before dcs are built separately
+        taken_names = set(self.inventory.hosts)
+        dc_host_names = list()
+        for dc_full_code, server_entries in dc_servers:
+            host_names = list()
+            for server_entry in server_entries:
+                server = parse_object(server_entry, HOST_NAME_SCHEMA)
+                if not self._server_matches_filters(server):
+                    host_names.append(None)
+                    continue
+                name = server["name"]
+                while name in taken_names:
+                    name = name + "_" + server["id"]
+                taken_names.add(name)
+                host_names.append(name)
+            dc_host_names.append(host_names)
+
+        max_workers = min(parallel_workers, len(dc_servers))
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_worker, initargs=(self,)) as executor:
+            futures = [
+                executor.submit(populate_dc_worker, dc_full_code, server_entries, host_names)
+                for (dc_full_code, server_entries), host_names in zip(dc_servers, dc_host_names)
+            ]
+            for future in futures:
+                try:
+                    dump = future.result()
+                except Exception as e:
+                    raise AnsibleError("Error building hosts in worker process: %s" % to_native(e))
+                if "error" in dump:
+                    raise AnsibleError(dump["error"])
+                self._merge_inventory_dump(dump)
+
+    def _merge_inventory_dump(self, dump):
+        '''
+        Merge hosts, groups and vars built by a worker process into inventory
+        '''
+        for name, variables in dump["hosts"]:
+            self.inventory.add_host(host=name, group='arvan')
+            for attribute, value in variables.items():
+                self.inventory.set_variable(name, attribute, value)
+
+        for group_name, children, hosts, variables in dump["groups"]:
+            self.inventory.add_group(group_name)
+            for attribute, value in variables.items():
+                self.inventory.set_variable(group_name, attribute, value)
+            for host in hosts:
+                self.inventory.add_host(host=host, group=group_name)
+
+        for group_name, children, hosts, variables in dump["groups"]:
+            for child in children:
+                self.inventory.add_child(group_name, child)
+
+    def _server_matches_filters(self, server):
+        # Filter by tag is not supported by the api and will be checked against every server
+        filter_by_tag = self.get_option('filter_by_tag')
+        tags = [tag.get("name") for tag in server.get("tags")]
+        return not filter_by_tag or filter_by_tag in tags
+
+    def _populate_dc(self, dc_full_code, server_entries, host_names=None):
+        '''
+        Add servers of a dc to inventory, with names in host_names if given
+        '''
+        # Use constructed if applicable
+        strict = self.get_option('strict')
+
+        for position, server_entry in enumerate(server_entries):
+            server = parse_object(server_entry, SERVER_SCHEMA)
+            if not self._server_matches_filters(server):
+                continue
+            server["tags"] = [tag.get("name") for tag in server.get("tags")]
+            addresses_spec = server.get("addresses")
+            hostname_preference = self.get_option('hostname')
+            # Find first available public & private ip addresses & set appropiate keys
+            try:
+                # first available fixed version 4 public ip address
+                addr = apply_filter(addresses_spec, is_public=True, version="4", type="fixed")[0].get("addr")
+                server["v4_public_ip"] = addr
+            except Exception:
+                if hostname_preference == "v4_public_ip":
+                    hostname_preference = "name"
+            try:
+                # first available version 4 private ip address
+                addr = apply_filter(addresses_spec, is_public=False, version="4", type="fixed")[0].get("addr")
+                server["v4_private_ip"] = addr
+            except Exception:
+                if hostname_preference == "v4_private_ip":
+                    hostname_preference = "name"
+            try:
+                # first available version 6 public ip address
+                addr = apply_filter(addresses_spec, is_public=True, version="6", type="fixed")[0].get("addr")
+                server["v6_public_ip"] = addr
+            except Exception:
+                if hostname_preference == "v6_public_ip":
+                    hostname_preference = "name"
+
+            if hostname_preference in ("v4_private_or_public_ip", "v4_public_or_private_ip") and\
+                    not server.get("v4_public_ip") and not server.get("v4_private_ip"):
+                hostname_preference = "name"
+
+            del server["addresses"]
+
+            # merge server and dc keys
+            server.update(self.dcs[dc_full_code])
+
+            if host_names:
+                server["name"] = host_names[position]
             else:
-                for server_entry in thread.response_data:
-                    server = parse_object(server_entry, SERVER_SCHEMA)
-                    try:
-                        tags = [tag.get("name") for tag in server.get("tags")]
-                        if filter_by_tag and filter_by_tag not in tags:
-                            continue
-                        addresses_spec = server.get("addresses")
-                    except KeyError:
-                        # Ignore servers without tags or addresses key
-                        continue
-                    server["tags"] = tags
-                    hostname_preference = self.get_option('hostname')
-                    # Find first available public & private ip addresses & set appropiate keys
-                    try:
-                        # first available fixed version 4 public ip address
-                        addr = apply_filter(addresses_spec, is_public=True, version="4", type="fixed")[0].get("addr")
-                        server["v4_public_ip"] = addr
-                    except Exception:
-                        if hostname_preference == "v4_public_ip":
-                            hostname_preference = "name"
-                    try:
-                        # first available version 4 private ip address
-                        addr = apply_filter(addresses_spec, is_public=False, version="4", type="fixed")[0].get("addr")
-                        server["v4_private_ip"] = addr
-                    except Exception:
-                        if hostname_preference == "v4_private_ip":
-                            hostname_preference = "name"
-                    try:
-                        # first available version 6 public ip address
-                        addr = apply_filter(addresses_spec, is_public=True, version="6", type="fixed")[0].get("addr")
-                        server["v6_public_ip"] = addr
-                    except Exception:
-                        if hostname_preference == "v6_public_ip":
-                            hostname_preference = "name"
-
-                    if hostname_preference in ("v4_private_or_public_ip", "v4_public_or_private_ip") and\
-                            not server.get("v4_public_ip") and not server.get("v4_private_ip"):
-                        hostname_preference = "name"
-
-                    del server["addresses"]
-
-                    # merge server and dc keys
-                    server.update(dcs[thread.dc])
-
-                    # If there is a server with same name in inventory, append id to its name
-                    while server["name"] in self.inventory.hosts:
-                        server["name"] = server["name"] + "_" + server["id"]
-
-                    # create host and add to arvan group
-                    self.inventory.add_host(host=server['name'], group='arvan')
-
-                    # set other attributes
-                    for attribute, value in server.items():
-                        self.inventory.set_variable(server['name'], attribute, value)
-
-                    if hostname_preference != 'name':
-                        if hostname_preference == "v4_private_or_public_ip":
-                            addr = server.get("v4_private_ip") or server.get("v4_public_ip")
-                        elif hostname_preference == "v4_public_or_private_ip":
-                            addr = server.get("v4_public_ip") or server.get("v4_private_ip")
-                        else:
-                            addr = server.get(hostname_preference)
-                        self.inventory.set_variable(server['name'], 'ansible_host', addr)
-
-                    # Composed variables
-                    self._set_composite_vars(self.get_option('compose'), server, server['name'], strict=strict)
-
-                    # Complex groups based on jinja2 conditionals, hosts that meet the conditional are added to group
-                    self._add_host_to_composed_groups(self.get_option('groups'), server, server['name'], strict=strict)
-
-                    # Create groups based on variable values and add the corresponding hosts to it
-                    self._add_host_to_keyed_groups(self.get_option('keyed_groups'), server, server['name'], strict=strict)
+                # If there is a server with same name in inventory, append id to its name
+                while server["name"] in self.inventory.hosts:
+                    server["name"] = server["name"] + "_" + server["id"]
+
+            # create host and add to arvan group
+            self.inventory.add_host(host=server['name'], group='arvan')
+
+            # set other attributes
+            for attribute, value in server.items():
+                self.inventory.set_variable(server['name'], attribute, value)
+
+            if hostname_preference != 'name':
+                if hostname_preference == "v4_private_or_public_ip":
+                    addr = server.get("v4_private_ip") or server.get("v4_public_ip")
+                elif hostname_preference == "v4_public_or_private_ip":
+                    addr = server.get("v4_public_ip") or server.get("v4_private_ip")
+                else:
+                    addr = server.get(hostname_preference)
+                self.inventory.set_variable(server['name'], 'ansible_host', addr)
+
+            # Composed variables
+            self._set_composite_vars(self.get_option('compose'), server, server['name'], strict=strict)
+
+            # Complex groups based on jinja2 conditionals, hosts that meet the conditional are added to group
+            self._add_host_to_composed_groups(self.get_option('groups'), server, server['name'], strict=strict)
+
+            # Create groups based on variable values and add the corresponding hosts to it
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), server, server['name'], strict=strict)
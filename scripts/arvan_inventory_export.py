@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2022, Zahir Mohsen Moradi <zm.moradi@protonmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+'''
+Run an arvan inventory file once and write the result as a static inventory
+
+Example command line: arvan_inventory_export.py -i inventory_arvan.yml -o inventory.json --skip-unchanged
+'''
+
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import sys
+
+# Collection root, so helpers of the inventory plugin can be imported when run as a script
+COLLECTION_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if COLLECTION_ROOT not in sys.path:
+    sys.path.insert(0, COLLECTION_ROOT)
+
+from plugins.inventory.arvan import host_variables, write_file_atomic  # noqa: E402
+
+
+def inventory_to_dict(inventory):
+    '''
+    Convert hosts and groups of an inventory to the structure printed by ansible-inventory --list
+    '''
+    result = {"_meta": {"hostvars": dict()}}
+    for name, group in inventory.groups.items():
+        entry = dict()
+        if name != "all":
+            hosts = sorted(host.name for host in group.hosts)
+            if hosts:
+                entry["hosts"] = hosts
+        children = sorted(child.name for child in group.child_groups)
+        if children:
+            entry["children"] = children
+        if group.vars:
+            entry["vars"] = dict(group.vars)
+        if entry:
+            result[name] = entry
+    for name, host in inventory.hosts.items():
+        hostvars = host_variables(host)
+        if hostvars:
+            result["_meta"]["hostvars"][name] = hostvars
+    return result
+
+
+def inventory_dict_to_yaml_tree(data):
+    '''
+    Convert output of inventory_to_dict to the tree used by the yaml inventory plugin
+    '''
+    def group_tree(name):
+        entry = data.get(name, dict())
+        tree = dict()
+        if entry.get("hosts"):
+            tree["hosts"] = dict((host, None) for host in entry["hosts"])
+        if entry.get("children"):
+            tree["children"] = dict((child, group_tree(child)) for child in entry["children"])
+        if entry.get("vars"):
+            tree["vars"] = entry["vars"]
+        return tree
+
+    tree = group_tree("all")
+    # Host vars are defined once under all, groups only list their hosts
+    if data["_meta"]["hostvars"]:
+        tree["hosts"] = data["_meta"]["hostvars"]
+    return {"all": tree}
+
+
+def render(data, output_format="json"):
+    '''
+    Serialize inventory dict, keys are sorted so same inventory renders to same bytes
+    '''
+    if output_format == "yaml":
+        import yaml
+        from ansible.parsing.yaml.dumper import AnsibleDumper
+        return yaml.dump(inventory_dict_to_yaml_tree(data), Dumper=AnsibleDumper, default_flow_style=False, sort_keys=True)
+    from ansible.parsing.ajson import AnsibleJSONEncoder
+    return json.dumps(data, cls=AnsibleJSONEncoder, sort_keys=True, separators=(",", ":")) + "\n"
+
+
+def write_output(path, content, skip_unchanged=False):
+    '''
+    Atomically replace path with content, return False if skip_unchanged and file already has this content
+    '''
+    if skip_unchanged:
+        try:
+            with open(path, "rb") as fp:
+                if fp.read() == content.encode("utf-8"):
+                    return False
+        except (IOError, OSError):
+            pass
+    write_file_atomic(path, content)
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export an arvan inventory file to a static inventory")
+    parser.add_argument("-i", "--inventory", required=True, help="inventory file ending with arvan.yml or arvan.yaml")
+    parser.add_argument("-o", "--output", required=True, help="path of static inventory to write")
+    parser.add_argument("-f", "--format", choices=("json", "yaml"), default="json", help="format of static inventory")
+    parser.add_argument("--skip-unchanged", action="store_true", help="do not rewrite output if its content is unchanged")
+    args = parser.parse_args(argv)
+
+    # Fail instead of writing an empty inventory if the inventory file could not be parsed
+    os.environ.setdefault("ANSIBLE_INVENTORY_UNPARSED_FAILED", "true")
+
+    from ansible.errors import AnsibleError
+    from ansible.inventory.manager import InventoryManager
+    from ansible.parsing.dataloader import DataLoader
+    try:
+        from ansible.plugins.loader import init_plugin_loader
+    except ImportError:
+        # ansible < 2.15 configures collection loader on import
+        init_plugin_loader = None
+
+    if init_plugin_loader:
+        init_plugin_loader()
+    try:
+        inventory = InventoryManager(loader=DataLoader(), sources=[args.inventory])
+        written = write_output(args.output, render(inventory_to_dict(inventory), args.format), args.skip_unchanged)
+    except (AnsibleError, IOError, OSError) as e:
+        print("Error exporting %s: %s" % (args.inventory, e), file=sys.stderr)
+        return 1
+    print("%s %s" % ("Wrote" if written else "Unchanged", args.output))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,11 +7,15 @@ from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 
 from os import path, listdir, environ
+import fcntl
 import json
+import subprocess
+import sys
+import threading
 import pytest
 from mock import MagicMock, patch
 
-from plugins.inventory.arvan import InventoryModule, GetAPIRequestThread, DOCUMENTATION, ARVAN_API_ENDPOINT
+from plugins.inventory.arvan import InventoryModule, GetAPIRequestThread, InventorySnapshot, snapshot_identity, DOCUMENTATION, ARVAN_API_ENDPOINT
 
 from ansible.errors import AnsibleError
 from ansible.parsing.dataloader import DataLoader
@@ -32,7 +36,7 @@ def pytest_generate_tests(metafunc):
 
 
 dirname = path.dirname(path.abspath(__file__))
-inventory_paths = [path.abspath("{0}/fixtures/yml/inventory{1}_arvan.yml".format(dirname, n)) for n in range(12)]
+inventory_paths = [path.abspath("{0}/fixtures/yml/inventory{1}_arvan.yml".format(dirname, n)) for n in range(16)]
 api_config_paths = [path.abspath("{0}/fixtures/ini/api_config{1}.ini".format(dirname, n)) for n in range(3)]
 json_base_path = path.abspath("%s/fixtures/json/" % dirname)
 success_servers_res = {"ir-tbz-dc1": 200, "ir-thr-at1": 200, "ir-thr-c2": 200, "ir-thr-mn1": 200, "nl-ams-su1": 200}
@@ -243,7 +247,114 @@ class TestPluginInventoryArvan:
                 get_dcs_status=200, get_servers_status=dict(success_servers_res),
                 inv_file=inventory_paths[11], raise_error=False, raise_error_match=""
             ),
-        }
+            "parallel_workers: 2":
+            dict(
+                change_server_keys=dict(), expected_groups={"arvan": ["vm0", "vm1", "vm2"], "dc_ir_tbz_dc1": ["vm0"], "dc_nl_ams_su1": ["vm1", "vm2"]},
+                expected_hosts={
+                    "vm0": dict(ansible_host="188.121.111.89", dc_full_code="ir-tbz-dc1"),
+                    "vm1": dict(ansible_host="130.185.122.57", ansible_user="fedora"),
+                    "vm2": dict(ansible_host="130.185.122.205", dc_full_code="nl-ams-su1")
+                },
+                get_dcs_status=200, get_servers_status=dict(success_servers_res),
+                inv_file=inventory_paths[12], raise_error=False, raise_error_match=""
+            ),
+            "parallel_workers: 3 & strict: true with undefined variable":
+            dict(
+                change_server_keys=dict(), expected_groups={}, expected_hosts={},
+                get_dcs_status=200, get_servers_status=dict(success_servers_res),
+                inv_file=inventory_paths[13], raise_error=True, raise_error_match="^Could not set x for host vm0: 'undefined_var' is undefined$"
+            ),
+        },
+        "test_parallel_same_as_serial": {
+            "unique names":
+            dict(change_server_keys=dict()),
+            "same name in all dcs":
+            dict(change_server_keys=dict(vm0={"name": "web"}, vm1={"name": "web"}, vm2={"name": "web"})),
+            "same name in one dc":
+            dict(change_server_keys=dict(vm1={"name": "web"}, vm2={"name": "web"})),
+        },
+        "test_parallel_snapshot_released": {
+            "fork available":
+            dict(expected_parallel=True, start_methods=["fork", "spawn"]),
+            "fork not available":
+            dict(expected_parallel=False, start_methods=["spawn"]),
+        },
+        "test_snapshot": {
+            "servers loaded from snapshot":
+            dict(change_server_keys=dict(), expected_hosts=["vm0", "vm1", "vm2"], fill_inv_file=inventory_paths[2], inv_file=inventory_paths[2]),
+            "filter_by_dcs: [Herman, nl-ams-su1] loaded from snapshot":
+            dict(change_server_keys=dict(), expected_hosts=["vm1", "vm2"], fill_inv_file=inventory_paths[15], inv_file=inventory_paths[6]),
+            "filter_by_tag: tag1 loaded from snapshot":
+            dict(
+                change_server_keys=dict(vm1={"tags": [{"name": "tag1", "id": "7777"}]}), expected_hosts=["vm1"],
+                fill_inv_file=inventory_paths[15], inv_file=inventory_paths[7]
+            ),
+        },
+        "test_delta": {
+            "no change":
+            dict(change_server_keys=dict(), expected_added=[], expected_changed=[], expected_removed_ids=[]),
+            "status & tags changed":
+            dict(
+                change_server_keys=dict(vm1={"status": "SHUTOFF"}, vm2={"tags": [{"name": "tag1", "id": "7777"}]}),
+                expected_added=[], expected_changed=["vm1", "vm2"], expected_removed_ids=[]
+            ),
+            "server replaced":
+            dict(
+                change_server_keys=dict(vm0={"id": "00000000-0000-0000-0000-000000000000"}),
+                expected_added=["vm0"], expected_changed=[], expected_removed_ids=["2693b214-98f4-4c84-9af8-31e053c76fe2"]
+            ),
+        },
+        "test_snapshot_identity": {
+            "same api key":
+            dict(env_vars=dict(), expected_hosts=["vm0", "vm1", "vm2"]),
+            "another api key":
+            dict(env_vars=dict(ARVAN_API_KEY="Apikey nnn"), expected_hosts=["vm0_other", "vm1_other", "vm2_other"]),
+            "another api endpoint":
+            dict(env_vars=dict(ARVAN_API_ENDPOINT="APIENDPOINT2"), expected_hosts=["vm0_other", "vm1_other", "vm2_other"]),
+        },
+        "test_snapshot_lock": {
+            "no lock":
+            dict(expected_api_calls=True, fill_snapshot=False, lock_owner=None),
+            "lock file left by a process which is not running":
+            dict(expected_api_calls=True, fill_snapshot=False, lock_owner="dead"),
+            "lock owner fills snapshot":
+            dict(expected_api_calls=False, fill_snapshot=True, lock_owner="alive"),
+            "lock owner does not finish before timeout":
+            dict(expected_api_calls=True, fill_snapshot=False, lock_owner="alive"),
+        },
+        "test_import_is_lazy": {
+            "http, snapshot & process pool modules":
+            dict(lazy_modules=["ansible.module_utils.urls", "sqlite3", "concurrent.futures.process"]),
+        },
+        "test_delta_malformed_state": {
+            "not json":
+            dict(state="{not json"),
+            "list instead of dict":
+            dict(state="[1, 2]"),
+            "fingerprint without dc":
+            dict(state='{"2693b214-98f4-4c84-9af8-31e053c76fe2": "0123456789abcdef"}'),
+            "entry with 3 items":
+            dict(state='{"2693b214-98f4-4c84-9af8-31e053c76fe2": ["ir-tbz-dc1", "0123456789abcdef", 1]}'),
+        },
+        "test_delta_failed_dc": {
+            "no change while dc failed":
+            dict(change_server_keys=dict(), expected_changed=[]),
+            "server changed while dc failed":
+            dict(change_server_keys=dict(vm1={"status": "SHUTOFF"}), expected_changed=["vm1"]),
+        },
+        "test_refresh_dcs": {
+            "refresh_dcs: [nl-ams-su1]":
+            dict(expected_fetched_dcs=["nl-ams-su1"], expected_hosts=["vm0", "vm1_new", "vm2_new"], missing_dcs=[], refresh_dcs="nl-ams-su1"),
+            "refresh_dcs: [Shahriar]":
+            dict(expected_fetched_dcs=["ir-tbz-dc1"], expected_hosts=["vm0_new", "vm1", "vm2"], missing_dcs=[], refresh_dcs="Shahriar"),
+            "refresh_dcs: [ir-thr-c2, nl-ams-su1]":
+            dict(
+                expected_fetched_dcs=["ir-thr-c2", "nl-ams-su1"], expected_hosts=["vm0", "vm1_new", "vm2_new"], missing_dcs=[],
+                refresh_dcs="ir-thr-c2,nl-ams-su1"
+            ),
+            "refresh_dcs: [nl-ams-su1] & nl-ams-su1 not in snapshot dcs":
+            dict(expected_fetched_dcs=["nl-ams-su1"], expected_hosts=["vm0", "vm1_new", "vm2_new"], missing_dcs=["nl-ams-su1"], refresh_dcs="nl-ams-su1"),
+        },
     }
 
     def test_no_api_key_raise_AnsibleError(self, env_vars, inv_file):
@@ -317,3 +428,233 @@ class TestPluginInventoryArvan:
                                 same_groups_in_result_and_expected = False
                                 break
                     assert expected_num_of_hosts == result_num_of_hosts and same_groups_in_result_and_expected and same_hosts_in_result_and_expected
+
+    def test_parallel_same_as_serial(self, change_server_keys):
+        results = list()
+        for parallel_workers in ("0", "3"):
+            with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+                with patch.dict(environ, dict(ARVAN_PARALLEL_WORKERS=parallel_workers)):
+                    api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                    for dc in api_gen.servers:
+                        for s in api_gen.servers[dc]:
+                            s.update(change_server_keys.get(s.get("name"), dict()))
+                    api_request.side_effect = api_gen.side_effect
+                    inv = create_InventoryModule()
+                    inv.parse(InventoryData(), DataLoader(), inventory_paths[14])
+                    hosts = [(name, dict(host.vars)) for name, host in inv.inventory.hosts.items()]
+                    groups = dict(
+                        (name, (sorted(h.name for h in group.hosts), sorted(g.name for g in group.child_groups)))
+                        for name, group in inv.inventory.groups.items()
+                    )
+                    results.append((hosts, groups))
+        assert results[0] == results[1]
+
+    def test_parallel_snapshot_released(self, expected_parallel, start_methods, tmp_path):
+        snapshot_path = str(tmp_path / "snapshot.sqlite")
+        closed = list()
+        close = InventorySnapshot.close
+
+        def close_snapshot(snapshot):
+            closed.append(snapshot)
+            close(snapshot)
+
+        def populate_parallel(plugin, dc_servers, parallel_workers):
+            # Workers must not inherit the snapshot connection or its lock
+            assert closed
+            with open(snapshot_path + ".lock") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            for dc_full_code, server_entries in dc_servers:
+                plugin._populate_dc(dc_full_code, server_entries)
+
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.object(InventoryModule, "_populate_parallel", autospec=True, side_effect=populate_parallel) as parallel:
+                with patch.object(InventorySnapshot, "close", autospec=True, side_effect=close_snapshot):
+                    with patch("multiprocessing.get_all_start_methods", return_value=start_methods):
+                        with patch.dict(environ, dict(ARVAN_SNAPSHOT_PATH=snapshot_path, ARVAN_PARALLEL_WORKERS="3")):
+                            api_request.side_effect = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res,
+                                                                           servers_res_status=success_servers_res).side_effect
+                            inv = create_InventoryModule()
+                            inv.parse(InventoryData(), DataLoader(), inventory_paths[14])
+        assert parallel.called == expected_parallel
+        assert sorted(h.name for h in inv.inventory.groups['arvan'].hosts) == ["vm0", "vm1", "vm2"]
+
+    def test_snapshot(self, change_server_keys, expected_hosts, fill_inv_file, inv_file, tmp_path):
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_SNAPSHOT_PATH=str(tmp_path / "snapshot.sqlite"))):
+                # First run fetches all dcs from API and fills snapshot
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                for dc in api_gen.servers:
+                    for s in api_gen.servers[dc]:
+                        s.update(change_server_keys.get(s.get("name"), dict()))
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), fill_inv_file)
+                # Second run must not need API
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=503, servers_res_status=dict())
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inv_file)
+                assert sorted(inv.inventory.hosts) == expected_hosts
+
+    def test_delta_malformed_state(self, state, tmp_path):
+        state_path = tmp_path / "delta.json"
+        state_path.write_text(state)
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_DELTA_STATE_PATH=str(state_path))):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                with pytest.raises(AnsibleError, match="^Error parsing delta state"):
+                    inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+
+    def test_delta_failed_dc(self, change_server_keys, expected_changed, tmp_path):
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_DELTA_STATE_PATH=str(tmp_path / "delta.json"))):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                # Servers of a dc which failed temporarily are not removed
+                api_gen.servers_res_status = update_return(success_servers_res, {"nl-ams-su1": 503})
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                assert sorted(inv.inventory.hosts) == ["vm0"]
+                assert [h.name for h in inv.inventory.groups["arvan_added"].hosts] == []
+                assert inv.inventory.groups["arvan"].vars["arvan_removed_ids"] == []
+                # nor added when it is fetched again
+                api_gen.servers_res_status = dict(success_servers_res)
+                for dc in api_gen.servers:
+                    for s in api_gen.servers[dc]:
+                        s.update(change_server_keys.get(s.get("name"), dict()))
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                assert [h.name for h in inv.inventory.groups["arvan_added"].hosts] == []
+                assert sorted(h.name for h in inv.inventory.groups["arvan_changed"].hosts) == expected_changed
+                assert inv.inventory.groups["arvan"].vars["arvan_removed_ids"] == []
+
+    def test_refresh_dcs(self, expected_fetched_dcs, expected_hosts, missing_dcs, refresh_dcs, tmp_path):
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_SNAPSHOT_PATH=str(tmp_path / "snapshot.sqlite"))):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                # Dcs which are new since snapshot was filled
+                api_gen.dcs = [dc for dc in api_gen.dcs if dc["code"] not in missing_dcs]
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+            # Snapshot is stale, but only refresh_dcs must be fetched again
+            with patch.dict(environ, dict(ARVAN_SNAPSHOT_PATH=str(tmp_path / "snapshot.sqlite"), ARVAN_SNAPSHOT_TIMEOUT="0", ARVAN_REFRESH_DCS=refresh_dcs)):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                for dc in api_gen.servers:
+                    for s in api_gen.servers[dc]:
+                        s["name"] = s["name"] + "_new"
+                api_request.side_effect = api_gen.side_effect
+                api_request.reset_mock()
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                assert sorted(c[1]["dc"] for c in api_request.call_args_list if c[1]["resource"] == "servers") == expected_fetched_dcs
+                assert sorted(inv.inventory.hosts) == expected_hosts
+
+    def test_delta(self, change_server_keys, expected_added, expected_changed, expected_removed_ids, tmp_path):
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_DELTA_STATE_PATH=str(tmp_path / "delta.json"))):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                # Without previous state all servers are added
+                assert sorted(h.name for h in inv.inventory.groups["arvan_added"].hosts) == ["vm0", "vm1", "vm2"]
+                for dc in api_gen.servers:
+                    for s in api_gen.servers[dc]:
+                        s.update(change_server_keys.get(s.get("name"), dict()))
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                assert sorted(h.name for h in inv.inventory.groups["arvan_added"].hosts) == expected_added
+                assert sorted(h.name for h in inv.inventory.groups["arvan_changed"].hosts) == expected_changed
+                assert inv.inventory.groups["arvan"].vars["arvan_removed_ids"] == expected_removed_ids
+
+    def test_snapshot_identity(self, env_vars, expected_hosts, tmp_path):
+        snapshot_env_vars = dict(ARVAN_SNAPSHOT_PATH=str(tmp_path / "snapshot.sqlite"), ARVAN_API_KEY="Apikey vvv")
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, snapshot_env_vars):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[0])
+            # Snapshot filled with Apikey vvv must only be used with the same key and endpoint
+            with patch.dict(environ, update_return(snapshot_env_vars, env_vars)):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                for dc in api_gen.servers:
+                    for s in api_gen.servers[dc]:
+                        s["name"] = s["name"] + "_other"
+                api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[0])
+                assert sorted(inv.inventory.hosts) == expected_hosts
+
+    def test_snapshot_lock(self, expected_api_calls, fill_snapshot, lock_owner, tmp_path):
+        snapshot_path = str(tmp_path / "snapshot.sqlite")
+        lock_path = snapshot_path + ".lock"
+        if lock_owner:
+            lock_file = open(lock_path, "w")
+        if lock_owner == "alive":
+            # flock locks of different open files conflict in the same process too
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        with patch("plugins.inventory.arvan.GetAPIRequestThread", autospec=GetAPIRequestThread) as api_request:
+            with patch.dict(environ, dict(ARVAN_SNAPSHOT_PATH=snapshot_path, ARVAN_SNAPSHOT_LOCK_TIMEOUT="2")):
+                api_gen = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=success_dcs_res, servers_res_status=success_servers_res)
+                if fill_snapshot:
+                    # Another process fetches while holding the lock, this one must only read the snapshot
+                    def fill():
+                        snapshot = InventorySnapshot(snapshot_path, snapshot_identity(ARVAN_API_ENDPOINT, "Apikey vvv"))
+                        snapshot.save_dcs(api_gen.dcs)
+                        for dc in api_gen.servers:
+                            snapshot.save_servers(dc, api_gen.servers[dc])
+                        snapshot.close()
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                    filler = threading.Timer(0.5, fill)
+                    filler.start()
+                    api_request.side_effect = APIResponseGenerator(json_base_path=json_base_path, dcs_res_status=503, servers_res_status=dict()).side_effect
+                else:
+                    api_request.side_effect = api_gen.side_effect
+                inv = create_InventoryModule()
+                inv.parse(InventoryData(), DataLoader(), inventory_paths[2])
+                if fill_snapshot:
+                    filler.join()
+                if lock_owner:
+                    lock_file.close()
+                assert api_request.called == expected_api_calls
+                assert sorted(inv.inventory.hosts) == ["vm0", "vm1", "vm2"]
+                # Lock is not held anymore
+                with open(lock_path) as fp:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_import_is_lazy(self, lazy_modules):
+        # Modules only needed to fetch servers must not be imported when ansible loads the plugin
+        collection_root = path.abspath(path.join(dirname, "..", "..", "..", ".."))
+        base = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c", "import ansible.plugins.inventory, ansible.inventory.data"],
+            cwd=collection_root, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        result = subprocess.check_output(
+            [sys.executable, "-X", "importtime", "-c", "import ansible.plugins.inventory, ansible.inventory.data; import plugins.inventory.arvan"],
+            cwd=collection_root, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        already_imported = set(line.split("|")[-1].strip() for line in base.splitlines() if "|" in line)
+        cumulative = dict()
+        imported = set()
+        for line in result.splitlines():
+            if line.startswith("import time:") and "|" in line:
+                self_us, cumulative_us, name = line[len("import time:"):].split("|")
+                if not cumulative_us.strip().isdigit():
+                    # Header line
+                    continue
+                cumulative[name.strip()] = int(cumulative_us)
+                if name.strip() not in already_imported:
+                    imported.add(name.strip())
+        assert "plugins.inventory.arvan" in imported
+        # Loading the plugin must stay cheap compared to loading the ansible modules it is built on
+        ansible_us = cumulative["ansible.plugins.inventory"] + cumulative["ansible.inventory.data"]
+        assert cumulative["plugins.inventory.arvan"] < ansible_us * 0.1
+        for module in lazy_modules:
+            if module not in already_imported:
+                assert module not in imported
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright: (c) 2022, Zahir Mohsen Moradi <zm.moradi@protonmail.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+from os import chmod, stat, umask
+import json
+
+from scripts.arvan_inventory_export import inventory_to_dict, render, write_output
+
+from ansible.inventory.data import InventoryData
+from ansible.parsing.yaml.loader import AnsibleLoader
+
+
+def build_inventory():
+    inventory = InventoryData()
+    inventory.add_group("arvan")
+    inventory.add_group("foroogh")
+    inventory.add_child("arvan", "foroogh")
+    for name, dc_name in (("vm1", "Shahriar"), ("vm0", "Foroogh")):
+        inventory.add_host(name, group="arvan")
+        inventory.set_variable(name, "dc_name", dc_name)
+    inventory.add_host("vm0", group="foroogh")
+    inventory.set_variable("foroogh", "city", "Tehran")
+    inventory.reconcile_inventory()
+    return inventory
+
+
+def test_inventory_to_dict():
+    data = inventory_to_dict(build_inventory())
+    assert data["_meta"]["hostvars"] == {"vm0": {"dc_name": "Foroogh"}, "vm1": {"dc_name": "Shahriar"}}
+    assert data["arvan"] == {"hosts": ["vm0", "vm1"], "children": ["foroogh"]}
+    assert data["foroogh"] == {"hosts": ["vm0"], "vars": {"city": "Tehran"}}
+    assert "arvan" in data["all"]["children"]
+
+
+def test_render_is_deterministic():
+    data = inventory_to_dict(build_inventory())
+    assert render(data) == render(json.loads(render(data)))
+    assert json.loads(render(data)) == data
+
+
+def test_render_yaml():
+    tree = AnsibleLoader(render(inventory_to_dict(build_inventory()), "yaml")).get_single_data()
+    assert tree["all"]["hosts"]["vm0"] == {"dc_name": "Foroogh"}
+    assert tree["all"]["children"]["arvan"]["children"]["foroogh"] == {"hosts": {"vm0": None}, "vars": {"city": "Tehran"}}
+
+
+def test_write_output_skip_unchanged(tmp_path):
+    output = str(tmp_path / "inventory.json")
+    content = render(inventory_to_dict(build_inventory()))
+    assert write_output(output, content, skip_unchanged=True)
+    inode = stat(output).st_ino
+    assert not write_output(output, content, skip_unchanged=True)
+    assert stat(output).st_ino == inode
+    assert write_output(output, content)
+    assert stat(output).st_ino != inode
+    with open(output) as fp:
+        assert fp.read() == content
+    assert [entry.name for entry in tmp_path.iterdir()] == ["inventory.json"]
+
+
+def test_write_output_mode(tmp_path):
+    output = str(tmp_path / "inventory.json")
+    content = render(inventory_to_dict(build_inventory()))
+    old_umask = umask(0o077)
+    try:
+        assert write_output(output, content)
+    finally:
+        umask(old_umask)
+    assert stat(output).st_mode & 0o777 == 0o600
+    chmod(output, 0o640)
+    assert write_output(output, content)
+    assert stat(output).st_mode & 0o777 == 0o640